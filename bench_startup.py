@@ -0,0 +1,66 @@
+"""
+Measure the startup cost of short zipdump invocations.
+
+Usage: python bench_startup.py [ZIPFILE] [COUNT]
+
+ * lists the slowest imports, as reported by `python -X importtime`
+ * times COUNT runs of `zipdump -q ZIPFILE`, both as script, and as module,
+   the latter uses the cached bytecode, like the installed `zipdump` command.
+
+Without a ZIPFILE a small test archive is created.
+"""
+from __future__ import division, print_function, absolute_import, unicode_literals
+import sys
+import os
+import subprocess
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def importtimes(cmd):
+    """ Return (cumulative usec, module) for all imports done by <cmd>. """
+    p = subprocess.run([sys.executable, "-X", "importtime"] + cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, cwd=here)
+    result = []
+    for line in p.stderr.decode('utf-8', 'ignore').splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[12:].split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            result.append((int(fields[1]), fields[2].rstrip()))
+    return result
+
+def runtime(cmd, count):
+    """ Return the average wallclock time in msec for <cmd>. """
+    t0 = time.time()
+    for _ in range(count):
+        subprocess.run([sys.executable] + cmd, stdout=subprocess.DEVNULL, cwd=here)
+    return (time.time() - t0) * 1000 / count
+
+def makezip(path):
+    import zipfile
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        for i in range(20):
+            z.writestr("dir/file%d.txt" % i, b"test data " * (i+1))
+
+def main():
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if len(sys.argv) > 1:
+            zipname = os.path.abspath(sys.argv[1])
+        else:
+            zipname = os.path.join(tmpdir, "test.zip")
+            makezip(zipname)
+
+        print("slowest imports for zipdump -q:")
+        for usec, name in sorted(importtimes(["zipdump.py", "-q", zipname]), reverse=True)[:10]:
+            print("%8.2f ms  %s" % (usec/1000, name))
+
+        print()
+        print("%8.2f ms  python -c pass" % runtime(["-c", "pass"], count))
+        print("%8.2f ms  python -c 'import zipdump'" % runtime(["-c", "import zipdump"], count))
+        print("%8.2f ms  python zipdump.py -q" % runtime(["zipdump.py", "-q", zipname], count))
+        print("%8.2f ms  python -m zipdump -q" % runtime(["-m", "zipdump", "-q", zipname], count))
+
+if __name__ == '__main__':
+    main()
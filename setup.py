@@ -15,6 +15,7 @@ setup(name=name,
         "Programming Language :: Python",
     ],
     packages=['.'],
+    extras_require={'attack': ['numpy']},
     zip_safe=False,
     entry_points="""
         [console_scripts]
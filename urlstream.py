@@ -115,10 +115,13 @@ class urlstream(object):
                 self.clearrange()
                 if debuglog: print("read: entire file")
                 f = self.doreq()
-                return f.read()
-
-            # read until end of file
-            return self.next(None)
+                data = f.read()
+            else:
+                # read until end of file
+                data = self.next(None)
+            if data:
+                self.absolutepos += len(data)
+            return data
 
         # read chunk until size bytes received
         data = b""
@@ -150,6 +153,8 @@ class urlstream(object):
             self.absolutepos += size
         elif whence == SEEK_END and size<0:
             self.absolutepos = size
+        elif whence == SEEK_END and size==0:
+            self.absolutepos = self.getsize()
         else:
             raise IOError(EINVAL, "Invalid seek arguments")
 
@@ -163,6 +168,11 @@ class urlstream(object):
             if debuglog: print("tell -> ", self.absolutepos)
             return self.absolutepos
 
+        self.absolutepos += self.getsize()
+        return self.absolutepos
+
+    def getsize(self):
+        """ Determine the size of the resource using a HEAD request. """
         # note: with python3 i could have used the 'method' property
         saved_method = self.req.get_method
         self.req.get_method = lambda : 'HEAD'
@@ -180,9 +190,7 @@ class urlstream(object):
         self.req.get_method = saved_method
 
         self.contentLength = int(head_response.headers.get("Content-Length"))
-
-        self.absolutepos += self.contentLength
-        return self.absolutepos
+        return self.contentLength
 
     def doreq(self):
         """ Do the actual http request, translating 404 into ENOENT. """
@@ -197,6 +205,11 @@ class urlstream(object):
                 return err.fp
             raise
 
+    def close(self):
+        """ Drop the buffered data, each request uses its own connection. """
+        self.buffer = None
+        self.bufferstart = None
+
     # for supporting 'with'
     def __enter__(self):
         return self
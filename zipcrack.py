@@ -0,0 +1,525 @@
+"""
+Recover access to pkzip encrypted entries.
+
+ * test password candidates against the 12 byte encryption header,
+   only the rare survivors need a full decrypt + crc check.
+ * Biham-Kocher known plaintext attack, recovering the internal keys,
+   as used with the zipdump --keys option.
+
+This module also has the key schedule used by zipdump for decrypting,
+the lookup tables for recovery are only built by inittables() when needed.
+"""
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+
+def make_crc_tab(poly):
+    def calcentry(v, poly):
+        for _ in range(8):
+            v = (v>>1) ^ (poly if v&1 else 0)
+        return v
+    return tuple( calcentry(byte, poly) for byte in range(256) )
+
+CRCTAB = make_crc_tab(0xedb88320)
+
+INITIALKEYS = (0x12345678, 0x23456789, 0x34567890)
+
+# lookup tables for password and key recovery, see inittables.
+KEYSTREAMTAB = None
+CRCINVTAB = None
+ZI_2_16 = ZFILTER = None
+MULTINVTAB = FIBER2 = FIBER3 = None
+
+
+def initkeys(pw):
+    """ Run the key schedule for password <pw>, returns the 3 internal keys. """
+    crctab = CRCTAB
+    k0, k1, k2 = INITIALKEYS
+    for c in bytearray(pw):
+        k0 = crctab[(k0^c)&0xFF] ^ (k0>>8)
+        k1 = ((k1 + (k0&0xFF)) * 134775813 + 1) & 0xFFFFFFFF
+        k2 = crctab[(k2^(k1>>24))&0xFF] ^ (k2>>8)
+    return k0, k1, k2
+
+
+def decryptbytes(keys, data):
+    """
+    Decrypt <data> starting from the internal key state <keys>,
+    returns the plaintext, and the key state following it.
+    """
+    crctab = CRCTAB
+    k0, k1, k2 = keys
+    out = bytearray(data)
+    for i, c in enumerate(out):
+        t = (k2|2) & 0xFFFF
+        p = c ^ ((t * (t^1)) >> 8) & 0xFF
+        out[i] = p
+        k0 = crctab[(k0^p)&0xFF] ^ (k0>>8)
+        k1 = ((k1 + (k0&0xFF)) * 134775813 + 1) & 0xFFFFFFFF
+        k2 = crctab[(k2^(k1>>24))&0xFF] ^ (k2>>8)
+    return out, (k0, k1, k2)
+
+
+def checkbyte(ent):
+    """
+    The last byte of the encryption header is the msb of the crc,
+    or when flag bit 3 is set, bits 8..15 of the dos time.
+    """
+    if ent.flags&8:
+        return (ent.timestamp>>8)&0xFF
+    return ent.crc32>>24
+
+
+def testpasswords(header, check, words):
+    """
+    Return the candidates from <words> for which the decrypted
+    header ends in <check>.  Expect 1 in 256 false positives.
+    """
+    inittables()
+    crctab, kstab = CRCTAB, KEYSTREAMTAB
+    # only the first 11 bytes update the keys, the 12th is compared.
+    head, last = bytearray(header[:11]), bytearray(header)[11] ^ check
+    initialkeys = INITIALKEYS
+    survivors = []
+    for pw in words:
+        k0, k1, k2 = initialkeys
+        for c in bytearray(pw):
+            k0 = crctab[(k0^c)&0xFF] ^ (k0>>8)
+            k1 = ((k1 + (k0&0xFF)) * 134775813 + 1) & 0xFFFFFFFF
+            k2 = crctab[(k2^(k1>>24))&0xFF] ^ (k2>>8)
+        for c in head:
+            p = c ^ kstab[k2&0xFFFF]
+            k0 = crctab[(k0^p)&0xFF] ^ (k0>>8)
+            k1 = ((k1 + (k0&0xFF)) * 134775813 + 1) & 0xFFFFFFFF
+            k2 = crctab[(k2^(k1>>24))&0xFF] ^ (k2>>8)
+        if kstab[k2&0xFFFF] == last:
+            survivors.append(pw)
+    return survivors
+
+
+def readwordlist(fh, chunksize):
+    """ Yield lists of <chunksize> passwords, one password per line. """
+    words = []
+    for line in fh:
+        words.append(line.rstrip(b'\r\n'))
+        if len(words) >= chunksize:
+            yield words
+            words = []
+    if words:
+        yield words
+
+
+def findpassword(header, check, wordchunks, verify, jobs=None):
+    """
+    Test all passwords from the <wordchunks> lists against the encryption header,
+    using a pool of <jobs> processes.
+    <verify> is called for each survivor, and should do the full decrypt + crc check.
+
+    Returns the first password for which <verify> returns True, or None.
+    """
+    import functools
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for survivors in pool.imap_unordered(functools.partial(testpasswords, header, check), wordchunks):
+            for pw in survivors:
+                if verify(pw):
+                    return pw
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+######################################################
+#  Biham-Kocher known plaintext attack
+#
+#  Notation: Xi, Yi, Zi are the 3 internal keys before encrypting plaintext byte Pi,
+#  Ki the keystream byte derived from Zi.
+#
+#    X{i+1} = crc32(Xi, Pi)
+#    Y{i+1} = (Yi + lsb(X{i+1})) * MULT + 1
+#    Z{i+1} = crc32(Zi, msb(Y{i+1}))
+#
+#  First the keystream is used to reduce the 2^22 possible values of Z[2,32) at the
+#  end of the known plaintext down to the start.  Then for each remaining candidate
+#  the Z, Y and X lists are reconstructed for 8 consecutive positions, and checked
+#  against the rest of the known plaintext.
+######################################################
+
+MASK32 = 0xFFFFFFFF
+MASK_2_32 = 0xFFFFFFFC
+MASK_8_32 = 0xFFFFFF00
+MASK_10_32 = 0xFFFFFC00
+MASK_24_32 = 0xFF000000
+MASK_26_32 = 0xFC000000
+MAXDIFF_0_24 = 0x00FFFFFF + 0xFF
+MAXDIFF_0_26 = 0x03FFFFFF + 0xFF
+
+MULT = 134775813
+MULTINV = 0xD94FA8CD     # MULT * MULTINV == 1  mod 2^32
+
+def make_crcinv_tab(crctab):
+    tab = [0] * 256
+    for b, v in enumerate(crctab):
+        tab[v>>24] = ((v<<8) & MASK32) ^ b
+    return tuple(tab)
+
+def crc32(crc, b):
+    return (crc>>8) ^ CRCTAB[(crc^b)&0xFF]
+
+def crc32inv(crc, b):
+    return ((crc<<8) & MASK32) ^ CRCINVTAB[crc>>24] ^ b
+
+
+def make_keystream_tabs():
+    """
+    Returns, for each keystream byte:
+      * the 64 possible values of Z[2,16)
+      * those same values, indexed by their bits 10..15
+    """
+    zi_2_16 = [ [] for _ in range(256) ]
+    zfilter = [ [ [] for _ in range(64) ] for _ in range(256) ]
+    for z in range(0, 0x10000, 4):
+        k = KEYSTREAMTAB[z]
+        zi_2_16[k].append(z)
+        zfilter[k][z>>10].append(z)
+    return zi_2_16, zfilter
+
+
+def make_mult_tabs():
+    """
+    Returns x * MULTINV for all bytes x, and the 'fibers': the bytes x for which
+    msb(x * MULTINV) is within 0..1, or -1..1 of a given msb.
+    """
+    multinv = tuple( (x * MULTINV) & MASK32 for x in range(256) )
+    fiber2 = [ [] for _ in range(256) ]
+    fiber3 = [ [] for _ in range(256) ]
+    for x, prod in enumerate(multinv):
+        m = prod>>24
+        fiber2[m].append(x)
+        fiber2[(m+1)&0xFF].append(x)
+        fiber3[(m-1)&0xFF].append(x)
+        fiber3[m].append(x)
+        fiber3[(m+1)&0xFF].append(x)
+    return multinv, fiber2, fiber3
+
+def inittables():
+    """ Build the lookup tables, this is called by each function which may run in a worker process. """
+    global KEYSTREAMTAB, CRCINVTAB, ZI_2_16, ZFILTER, MULTINVTAB, FIBER2, FIBER3
+    if KEYSTREAMTAB is not None:
+        return
+    # the keystream byte only depends on bits 2..15 of key2
+    KEYSTREAMTAB = tuple( ((t|2) * ((t|2)^1) >> 8) & 0xFF for t in range(0x10000) )
+    CRCINVTAB = make_crcinv_tab(CRCTAB)
+    ZI_2_16, ZFILTER = make_keystream_tabs()
+    MULTINVTAB, FIBER2, FIBER3 = make_mult_tabs()
+
+# number of consecutive keystream bytes used to reconstruct the keys.
+ATTACKSIZE = 8
+
+# number of keystream bytes reduced per round, before combining the candidates.
+# the attack is carried out at the round boundary with the fewest candidates.
+REDUCEROUND = 8
+
+
+def reducez(keystream, start, stop, zlist):
+    """
+    Reduce the Z[2,32) candidates <zlist> for keystream index <start>
+    backwards to index <stop>.
+    """
+    inittables()
+    zfilter, crcinvtab = ZFILTER, CRCINVTAB
+    zlist = set(zlist)
+    for i in range(start, stop, -1):
+        filt = zfilter[keystream[i-1]]
+        reduced = set()
+        add = reduced.add
+        for z in zlist:
+            # inlined crc32inv(z, 0) & MASK_10_32
+            zim1_10_32 = ((z<<8) ^ crcinvtab[z>>24]) & MASK_10_32
+            for zim1_2_16 in filt[(zim1_10_32>>10)&0x3F]:
+                add(zim1_10_32 | zim1_2_16)
+        zlist = reduced
+        if not zlist:
+            break
+    return zlist
+
+
+def reducezslice(keystream, stop, hirange):
+    """
+    Generate the Z[2,32) candidates for the last keystream byte, with Z[16,32)
+    in <hirange>, and reduce them backwards to index <stop>.
+    """
+    inittables()
+    zlist = [ (hi<<16) | lo for hi in hirange for lo in ZI_2_16[keystream[-1]] ]
+    return reducez(keystream, len(keystream)-1, stop, zlist)
+
+
+def initvectortables():
+    """
+    Build the numpy versions of the multiplication tables, used by KnownPlaintextAttack.
+    Each fiber entry is stored along with its MULTINV product, the fibers are padded
+    to equal length with 0x100, which marks the entry as invalid.
+    """
+    global np, VCRCTAB, VCRCINVTAB, VKEYSTREAMTAB, VFIBER2, VFIBER3, Y7STEPS
+    if Y7STEPS is not None:
+        return
+    try:
+        import numpy as np
+    except ImportError:
+        raise ValueError("the known plaintext attack needs numpy: pip install numpy")
+    inittables()
+
+    def padded(fibers):
+        width = max(len(f) for f in fibers)
+        table = np.zeros((256, width, 2), dtype=np.uint32)
+        table[:, :, 0] = 0x100
+        for m, f in enumerate(fibers):
+            table[m, :len(f), 0] = f
+            table[m, :len(f), 1] = [ MULTINVTAB[x] for x in f ]
+        return table
+
+    VCRCTAB = np.array(CRCTAB, dtype=np.uint32)
+    VCRCINVTAB = np.array(CRCINVTAB, dtype=np.uint32)
+    VKEYSTREAMTAB = np.array(KEYSTREAMTAB, dtype=np.uint8)
+    VFIBER2 = padded(FIBER2)
+    VFIBER3 = padded(FIBER3)
+    # Y7[8,24) * MULTINV for all 2^16 values of Y7[8,24)
+    Y7STEPS = np.arange(0x10000, dtype=np.uint32) * np.uint32((MULTINV<<8) & MASK32)
+
+np = VCRCTAB = VCRCINVTAB = VKEYSTREAMTAB = VFIBER2 = VFIBER3 = Y7STEPS = None
+
+# crc32 and crc32inv for numpy arrays of uint32, which wrap around by themselves.
+def vcrc32(crc, b):
+    return (crc >> 8) ^ np.take(VCRCTAB, (crc ^ b) & 0xFF)
+
+def vcrc32inv(crc, b):
+    return (crc << 8) ^ np.take(VCRCINVTAB, crc >> 24) ^ b
+
+def vselect(mask, *arrays):
+    """ Returns the rows where the 2D <mask> is set, followed by the selected values of each of <arrays>. """
+    idx = np.flatnonzero(mask)
+    return (idx // mask.shape[1],) + tuple(a.ravel()[idx] for a in arrays)
+
+
+class KnownPlaintextAttack(object):
+    """
+    Recover the internal keys from the ciphertext of an entry, and at least 13
+    contiguous bytes of known plaintext.
+
+    <ciphertext> is the encrypted data starting with the 12 byte encryption header,
+    the plaintext is located at <offset> in the ciphertext.  The candidates are
+    Z[2,32) at keystream <index>, the keys are reconstructed for the 8 positions
+    ending there, and checked against the rest of the plaintext on both sides.
+
+    Note: for deflated entries the plaintext is the compressed data.
+    """
+    def __init__(self, ciphertext, plaintext, offset, index=ATTACKSIZE-1):
+        inittables()
+        initvectortables()
+        self.ciphertext = bytearray(ciphertext)
+        self.plaintext = bytearray(plaintext)
+        self.offset = offset
+        self.keystream = bytearray( c ^ p for c, p in zip(self.ciphertext[offset:], self.plaintext) )
+        # keystream index of zlist[0]
+        self.base = index - (ATTACKSIZE-1)
+
+        self.zlist = [0] * ATTACKSIZE
+        self.ylist = [0] * ATTACKSIZE
+        self.found = None
+
+    def carryout(self, z7_2_32):
+        """ Try to complete the keys from candidate Z7[2,32), returns the keys at the start of the ciphertext, or None. """
+        self.found = None
+        self.zlist[7] = z7_2_32
+        self.explorezlists(7)
+        return self.found
+
+    def explorezlists(self, i):
+        zlist, ylist = self.zlist, self.ylist
+        if i:
+            # Z{i-1}[10,32) follows from crc32^-1, Z{i-1}[2,16) from the keystream byte.
+            zim1_10_32 = crc32inv(zlist[i], 0) & MASK_10_32
+            for zim1_2_16 in ZFILTER[self.keystream[self.base+i-1]][(zim1_10_32>>10)&0x3F]:
+                zlist[i-1] = zim1_10_32 | zim1_2_16
+
+                # now Zi[0,2) can be determined
+                zlist[i] &= MASK_2_32
+                zlist[i] |= (crc32inv(zlist[i], 0) ^ zlist[i-1]) >> 8
+
+                # and Y{i+1}[24,32)
+                if i < 7:
+                    ylist[i+1] = ((crc32inv(zlist[i+1], 0) ^ zlist[i]) << 24) & MASK32
+
+                self.explorezlists(i-1)
+                if self.found:
+                    return
+        else:
+            self.exploreylists()
+
+    def exploreylists(self):
+        """
+        Guess Y7[0,24), and derive Y6..Y3 and lsb(X7..X4) from it.  Nearly every guess
+        leads to exactly one Y list, so this is the slow part of the attack: 2^16 lists
+        for each Z list.  All lists are checked at once with numpy, only the survivors
+        are walked back to the start of the ciphertext.
+        """
+        zlist, ylist = self.zlist, self.ylist
+        base = self.base
+        pt, ks = self.plaintext, self.keystream
+        ymsb = [ np.uint32(y & MASK_24_32) for y in ylist ]
+
+        # prod == (Y7[8,32) - 1) * MULTINV, Y7[0,8) is limited by Y6[24,32)
+        prod = np.uint32(((MULTINVTAB[ylist[7]>>24] << 24) - MULTINV) & MASK32) + Y7STEPS
+        fiber = ((ymsb[6] - prod) >> 24) & 0xFF
+        entries = np.take(VFIBER3, fiber, axis=0)
+        y7_0_8 = entries[:, :, 0]
+        rows, y7_0_8 = vselect((y7_0_8 < 0x100) & ((prod[:, None] + entries[:, :, 1] - ymsb[6]) <= MAXDIFF_0_24), y7_0_8)
+        ys = [ (rows.astype(np.uint32) << 8) | y7_0_8 | ymsb[7] ]
+        xs = []
+
+        for i in range(7, 3, -1):
+            fy = (ys[-1] - 1) * np.uint32(MULTINV)
+            ffy = (fy - 1) * np.uint32(MULTINV)
+            # the possible values of lsb(Xi)
+            fiber = (ffy - ymsb[i-2]) >> 24
+            entries = np.take(VFIBER2, fiber, axis=0)
+            xi_0_8 = entries[:, :, 0]
+            yim1 = fy[:, None] - xi_0_8
+            rows, yim1, xi_0_8 = vselect((xi_0_8 < 0x100) & ((ffy[:, None] - entries[:, :, 1] - ymsb[i-2]) <= MAXDIFF_0_24)
+                    & ((yim1 >> 24) == (ylist[i-1] >> 24)), yim1, xi_0_8)
+            ys = [ y[rows] for y in ys ] + [ yim1 ]
+            xs = [ x[rows] for x in xs ] + [ xi_0_8 ]
+        y7, y3 = ys[0], ys[4]
+
+        # X7 follows from lsb(X4..X7) and the plaintext
+        x7 = xs[3]
+        for i in range(5, 8):
+            x7 = (vcrc32(x7, pt[base+i-1]) & np.uint32(MASK_8_32)) | xs[7-i]
+        x3 = x7
+        for i in range(6, 2, -1):
+            x3 = vcrc32inv(x3, pt[base+i])
+
+        # check X3 against Y1[26,32)
+        y1_26_32 = np.uint32(((crc32inv(zlist[1], 0) ^ zlist[0]) << 24) & MASK_26_32)
+        ok = (((y3 - 1) * np.uint32(MULTINV) - (x3 & 0xFF) - 1) * np.uint32(MULTINV) - y1_26_32) <= MAXDIFF_0_26
+        k0, k1, x3, y3 = x7[ok], y7[ok], x3[ok], y3[ok]
+
+        # check the known plaintext following the attack position
+        k2 = np.full(len(k0), zlist[7], dtype=np.uint32)
+        for i in range(base+7, len(ks)):
+            ok = np.take(VKEYSTREAMTAB, k2 & 0xFFFF) == ks[i]
+            k0, k1, k2, x3, y3 = k0[ok], k1[ok], k2[ok], x3[ok], y3[ok]
+            if not len(k0):
+                return
+            k0 = vcrc32(k0, pt[i])
+            k1 = (k1 + (k0 & 0xFF)) * np.uint32(MULT) + 1
+            k2 = vcrc32(k2, k1 >> 24)
+
+        for x, y in zip(x3.tolist(), y3.tolist()):
+            self.found = self.walkback(x, y, zlist[3])
+            if self.found:
+                return
+
+    def walkback(self, k0, k1, k2):
+        """
+        Walk back from the keys at attack position 3 to the start of the ciphertext,
+        checking the plaintext before the attack position.  Returns the keys, or None.
+        """
+        pt = self.plaintext
+        for i in range(self.offset+self.base+2, -1, -1):
+            k2 = crc32inv(k2, k1>>24)
+            k1 = ((k1 - 1) * MULTINV - (k0&0xFF)) & MASK32
+            p = self.ciphertext[i] ^ KEYSTREAMTAB[k2&0xFFFF]
+            if i >= self.offset and p != pt[i-self.offset]:
+                return
+            k0 = crc32inv(k0, p)
+        return k0, k1, k2
+
+
+def attackchunk(ciphertext, plaintext, offset, index, zchunk):
+    """ Carry out the attack for a list of Z[2,32) candidates at keystream <index>. """
+    attack = KnownPlaintextAttack(ciphertext, plaintext, offset, index)
+    for z in zchunk:
+        keys = attack.carryout(z)
+        if keys:
+            return keys
+
+
+def formatduration(sec):
+    if sec < 120:
+        return "%d sec" % sec
+    if sec < 7200:
+        return "%d min" % (sec // 60)
+    if sec < 2*86400:
+        return "%.1f hours" % (sec / 3600)
+    return "%.1f days" % (sec / 86400)
+
+
+def recoverkeys(ciphertext, plaintext, offset, jobs=None, log=None):
+    """
+    Recover the internal keys at the start of <ciphertext> from the known <plaintext> at <offset>.
+    Both the Z reduction and the attack itself are spread over a pool of <jobs> processes,
+    <log> is called with progress messages.
+
+    The attack starts at the keystream index where the Z reduction left the fewest
+    candidates, more known plaintext gives more indexes to choose from.  Each
+    candidate takes about 20 msec cpu time, and needs numpy.
+    """
+    import time
+    import array
+    import functools
+    import multiprocessing
+    if len(plaintext) < 13:
+        raise ValueError("need at least 13 bytes of known plaintext")
+    if offset + len(plaintext) > len(ciphertext):
+        raise ValueError("known plaintext extends beyond the end of the entry")
+    attack = KnownPlaintextAttack(ciphertext, plaintext, offset)
+    if log is None:
+        log = lambda msg: None
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # the reduction is done in rounds of REDUCEROUND keystream bytes,
+        # chains from different slices merge, so the candidates are combined after each round.
+        t0 = time.time()
+        index = max(len(attack.keystream)-1-REDUCEROUND, ATTACKSIZE-1)
+        slices = [ range(hi, hi+0x100) for hi in range(0, 0x10000, 0x100) ]
+        zset = set()
+        for i, zpart in enumerate(pool.imap_unordered(functools.partial(reducezslice, attack.keystream, index), slices)):
+            zset |= zpart
+            log("Z reduction: index %d, %3d/%d slices, %d candidates, %.1f sec" % (
+                index, i+1, len(slices), len(zset), time.time() - t0))
+        best = (len(zset), index, array.array('I', zset))
+        nreduced = len(slices) * 0x100 * 64 * (len(attack.keystream)-1-index)
+        while index > ATTACKSIZE-1 and zset:
+            stop = max(index-REDUCEROUND, ATTACKSIZE-1)
+            nreduced += len(zset) * (index-stop)
+            zlist = list(zset)
+            nchunks = 4 * (jobs or multiprocessing.cpu_count())
+            chunks = [ zlist[i::nchunks] for i in range(nchunks) ]
+            zset = set()
+            for zpart in pool.imap_unordered(functools.partial(reducez, attack.keystream, index, stop), chunks):
+                zset |= zpart
+            index = stop
+            if len(zset) < best[0]:
+                best = (len(zset), index, array.array('I', zset))
+            log("Z reduction: index %d, %d candidates, %.0f values/sec" % (index, len(zset), nreduced / (time.time() - t0)))
+        zset = None
+
+        t0 = time.time()
+        n, index, zlist = best
+        log("attack: index %d, %d candidates" % (index, n))
+        zlist = sorted(zlist)
+        chunks = [ zlist[i:i+16] for i in range(0, len(zlist), 16) ]
+        ntested = 0
+        for keys in pool.imap_unordered(functools.partial(attackchunk, attack.ciphertext, attack.plaintext, offset, index), chunks):
+            if keys:
+                return keys
+            ntested += 16
+            dt = time.time() - t0
+            rate = ntested / dt if dt else 0
+            log("attack: %d/%d candidates, %.1f candidates/sec, %s remaining" % (
+                min(ntested, len(zlist)), len(zlist), rate, formatduration((len(zlist)-ntested) / rate) if rate else "?"))
+    finally:
+        pool.terminate()
+        pool.join()
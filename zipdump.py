@@ -14,14 +14,29 @@ import sys
 import os
 import binascii
 import struct
-import datetime
-import zlib
-import itertools
+import io
 if sys.version_info[0] == 2:
     import scandir
     os.scandir = scandir.scandir
 
 
+class ZipDecryptor(object):
+    """
+    Keeps the key state of the 'zip' encryption, so data can be decrypted
+    one block at a time, see zip_decrypt.  The key schedule is in zipcrack.
+    """
+    def __init__(self, pw):
+        import zipcrack
+        if type(pw)==list:
+            self.keys = tuple(pw)
+        else:
+            self.keys = zipcrack.initkeys(pw)
+
+    def decrypt(self, blk):
+        import zipcrack
+        u, self.keys = zipcrack.decryptbytes(self.keys, blk)
+        return u
+
 def zip_decrypt(data, pw):
     """
     INPUT: data  - an array of bytes
@@ -33,39 +48,9 @@ def zip_decrypt(data, pw):
     This encryption can be cracked using tools like pkcrack.
     Pkcrack does a known plaintext attack, requiring 13 bytes of plaintext.
     """
-    def make_crc_tab(poly):
-        def calcentry(v, poly):
-            for _ in range(8):
-                v = (v>>1) ^ (poly if v&1 else 0)
-            return v
-        return [ calcentry(byte, poly) for byte in range(256) ]
-
-    crctab = make_crc_tab(0xedb88320)
-
-    def crc32(crc, byte):
-        return crctab[(crc^byte)&0xff] ^ (crc>>8)
-
-    def updatekeys(keys, byte):
-        keys[0] = crc32(keys[0], byte)
-        keys[1] = ((keys[1] + (keys[0]&0xFF)) * 134775813 + 1)&0xFFFFFFFF
-        keys[2] = crc32(keys[2], keys[1]>>24)
-
-    keys = [ 0x12345678, 0x23456789, 0x34567890 ]
-    if type(pw)==list:
-        keys = pw
-    else:
-        for c in pw:
-            updatekeys(keys, c)
-
+    decryptor = ZipDecryptor(pw)
     for blk in data:
-        u = bytearray()
-        for b in bytearray(blk):
-            xor = (keys[2] | 2)&0xFFFF
-            xor = ((xor * (xor^1))>>8) & 0xFF
-            b = b ^ xor
-            u.append(b)
-            updatekeys(keys, b)
-        yield u
+        yield decryptor.decrypt(blk)
 
 def skipbytes(blks, skip, args):
     """
@@ -86,11 +71,12 @@ def skipbytes(blks, skip, args):
         else:
             yield blk
 
+NONPRINTABLE = frozenset('\u0009\u000b\u000c\u001c\u001d\u001e\u001f\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2008\u2009\u200a\u2028\u2029\u205f\u3000')
+
 def decode_name(name):
-    nonprint = set('\u0009\u000b\u000c\u001c\u001d\u001e\u001f\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2008\u2009\u200a\u2028\u2029\u205f\u3000')
     try:
         utf8 = name.decode('utf-8', 'strict')
-        if not nonprint & set(utf8) and utf8.isprintable():
+        if NONPRINTABLE.isdisjoint(utf8) and utf8.isprintable():
             return utf8
     except:
         pass
@@ -103,6 +89,7 @@ class EntryBase(object):
         pass
 
 def decodedatetime(ts):
+    import datetime
     def decode_date(dt):
         if dt==0:
             return datetime.datetime(1980,1,1)
@@ -118,6 +105,33 @@ def decodedatetime(ts):
 
     return decode_date(ts>>16) + decode_time(ts & 0xFFFF)
 
+def formatdatetime(ts):
+    """
+    Same as str(decodedatetime(ts)), but only importing datetime
+    for timestamps which need normalizing.
+    """
+    dt, tm = ts>>16, ts&0xFFFF
+    year, mon, day = (dt>>9)+1980, (dt>>5)&15, dt&31
+    hour, minute, second = tm>>11, (tm>>5)&63, (tm&31)*2
+    if dt and 1<=mon<=12 and 1<=day<=28 and hour<24 and minute<60 and second<60:
+        return "%04d-%02d-%02d %02d:%02d:%02d" % (year, mon, day, hour, minute, second)
+    return str(decodedatetime(ts))
+
+def filesummary(ent):
+    """ one line summary for CentralDirEntry and LocalFileHeader """
+    def flagdesc(fl):
+        if fl&64: return "AES"
+        if fl&1: return "CRYPT"
+        return ""
+    return "%10d (%5.1f%%)  %s  %08x [%5s] %s" % (
+            ent.originalSize,
+            100.0*ent.compressedSize/ent.originalSize if ent.originalSize else 0,
+            formatdatetime(ent.timestamp),
+            ent.crc32,
+            flagdesc(ent.flags),
+            ent.name
+            )
+
 ######################################################
 #  Decoder classes
 ######################################################
@@ -125,6 +139,7 @@ def decodedatetime(ts):
 class CentralDirEntry(EntryBase):
     HeaderSize = 42
     MagicNumber = b'\x01\x02'
+    HeaderStruct = struct.Struct("<4H4L5HLL")
 
     def __init__(self, baseofs, data, ofs):
         self.pkOffset = baseofs + ofs - 4
@@ -132,7 +147,7 @@ class CentralDirEntry(EntryBase):
         self.createVersion, self.neededVersion, self.flags, self.method, self.timestamp, \
             self.crc32, self.compressedSize, self.originalSize, self.nameLength, self.extraLength, \
             self.commentLength, self.diskNrStart, self.zipAttrs, self.osAttrs, self.dataOfs = \
-            struct.unpack_from("<4H4L5HLL", data, ofs)
+            self.HeaderStruct.unpack_from(data, ofs)
         ofs += self.HeaderSize
 
         self.nameOffset = baseofs + ofs
@@ -159,18 +174,7 @@ class CentralDirEntry(EntryBase):
         self.comment = fh.read(self.commentLength).decode("utf-8", "ignore")
 
     def summary(self):
-        def flagdesc(fl):
-            if fl&64: return "AES"
-            if fl&1: return "CRYPT"
-            return ""
-        return "%10d (%5.1f%%)  %s  %08x [%5s] %s" % (
-                self.originalSize,
-                100.0*self.compressedSize/self.originalSize if self.originalSize else 0,
-                decodedatetime(self.timestamp),
-                self.crc32,
-                flagdesc(self.flags),
-                self.name
-                )
+        return filesummary(self)
 
     def __repr__(self):
         r = "PK.0102: %04x %04x %04x %04x %08x %08x %08x %08x %04x %04x %04x %04x %04x %08x %08x |  %08x %08x %08x %08x" % (
@@ -186,13 +190,14 @@ class CentralDirEntry(EntryBase):
 class LocalFileHeader(EntryBase):
     HeaderSize = 26
     MagicNumber = b'\x03\x04'
+    HeaderStruct = struct.Struct("<3H4LHH")
 
     def __init__(self, baseofs, data, ofs):
         self.pkOffset = baseofs + ofs - 4
 
         self.neededVersion, self.flags, self.method, self.timestamp, self.crc32, \
             self.compressedSize, self.originalSize, self.nameLength, self.extraLength = \
-            struct.unpack_from("<3H4LHH", data, ofs)
+            self.HeaderStruct.unpack_from(data, ofs)
         ofs += self.HeaderSize
 
         self.nameOffset = baseofs + ofs
@@ -217,6 +222,9 @@ class LocalFileHeader(EntryBase):
         self.extra = fh.read(self.extraLength)
         # not loading data
 
+    def summary(self):
+        return filesummary(self)
+
     def __repr__(self):
         r = "PK.0304: %04x %04x %04x %08x %08x %08x %08x %04x %04x |  %08x %08x %08x %08x" % (
             self.neededVersion, self.flags, self.method, self.timestamp, self.crc32,
@@ -230,12 +238,13 @@ class LocalFileHeader(EntryBase):
 class EndOfCentralDir(EntryBase):
     HeaderSize = 18
     MagicNumber = b'\x05\x06'
+    HeaderStruct = struct.Struct("<4HLLH")
 
     def __init__(self, baseofs, data, ofs):
         self.pkOffset = baseofs + ofs - 4
 
         self.thisDiskNr, self.startDiskNr, self.thisEntries, self.totalEntries, self.dirSize, self.dirOffset, self.commentLength = \
-            struct.unpack_from("<4HLLH", data, ofs)
+            self.HeaderStruct.unpack_from(data, ofs)
         ofs += self.HeaderSize
 
         self.commentOffset = baseofs + ofs
@@ -273,12 +282,13 @@ class EndOfCentralDir(EntryBase):
 class DataDescriptor(EntryBase):
     HeaderSize = 12
     MagicNumber = b'\x07\x08'
+    HeaderStruct = struct.Struct("<3L")
 
     def __init__(self, baseofs, data, ofs):
         self.pkOffset = baseofs + ofs - 4
 
         self.crc, self.compSize, self.uncompSize = \
-            struct.unpack_from("<3L", data, ofs)
+            self.HeaderStruct.unpack_from(data, ofs)
         ofs += self.HeaderSize
 
         self.endOffset = baseofs + ofs
@@ -330,17 +340,22 @@ class ArchiveSignature(EntryBase):
         self.pkOffset = baseofs + ofs - 4
 
 
+DecoderClasses = dict( (cls.MagicNumber, cls) for cls in (CentralDirEntry, LocalFileHeader, EndOfCentralDir, DataDescriptor, Zip64EndOfDir, Zip64EndOfDirLocator, ExtraEntry, SpannedArchive, ArchiveSignature) )
+
 def getDecoderClass(typ):
     """ Return Decoder class for the PK type. """
-    for cls in (CentralDirEntry, LocalFileHeader, EndOfCentralDir, DataDescriptor, Zip64EndOfDir, Zip64EndOfDirLocator, ExtraEntry, SpannedArchive, ArchiveSignature):
-        if cls.MagicNumber == typ:
-            return cls
+    return DecoderClasses.get(typ)
 
 
-def findPKHeaders(args, fh):
-    """ Scan the entire file for PK headers. """
+def findPKHeaders(args, fh, onchunk=None):
+    """
+    Scan the entire file for PK headers.
 
-    def processchunk(o, chunk):
+    <onchunk> is called with the file offset and data of each chunk,
+    before the headers found in it are yielded.
+    """
+
+    def processchunk(o, chunk, skip):
         n = -1
         while True:
             n = chunk.find(b'PK', n+1)
@@ -352,9 +367,9 @@ def findPKHeaders(args, fh):
                 if hdrEnd > len(chunk):
                     continue
 
-                # todo: skip entries entirely within repeated chunk
-                # if n<64 and hdrEnd>64:
-                #    continue
+                # skip entries entirely within the repeated part, these were found in the previous chunk
+                if hdrEnd <= skip:
+                    continue
 
                 yield cls(o, chunk, n+4)
 
@@ -367,11 +382,14 @@ def findPKHeaders(args, fh):
         want = args.chunksize
         if args.length is not None and want > args.length - o:
             want = args.length - o
-        fh.seek(o)
+        if not onchunk:
+            fh.seek(o)
         chunk = fh.read(want)
         if len(chunk) == 0:
             break
-        for ch in processchunk(o-len(prev), prev+chunk):
+        if onchunk:
+            onchunk(o-len(prev), prev+chunk)
+        for ch in processchunk(o-len(prev), prev+chunk, len(prev)):
             yield ch
 
         # 64 so all header types would fit, exclusive their variable size parts
@@ -379,33 +397,37 @@ def findPKHeaders(args, fh):
         o += len(chunk)
 
 
+class BadZipError(ValueError):
+    """ raised by quickScanZip when the central directory can't be found """
+    pass
+
 def quickScanZip(args, fh):
-    """ Do a quick scan of the .zip file, starting by locating the EOD marker. """
+    """
+    Do a quick scan of the .zip file, starting by locating the EOD marker.
+    Raises BadZipError when the file does not end with a valid central directory.
+    """
     # 100 bytes is the smallest .zip possible
 
     fh.seek(0, 2)
     fsize = fh.tell()
     if fsize==0:
-        print("Empty file")
-        return
+        raise BadZipError("Empty file")
     if fsize<100:
-        print("Zip too small: %d bytes, minimum zip is 100 bytes" % fsize)
-        return
+        raise BadZipError("Zip too small: %d bytes, minimum zip is 100 bytes" % fsize)
     fh.seek(-100, 2)
 
     eoddata = fh.read()
     iEND = eoddata.find(b'PK\x05\x06')
     if iEND==-1:
         # try with larger chunk
-        ofs = max(fh.tell()-0x10100, 0)
+        ofs = max(fsize-0x10100, 0)
         fh.seek(ofs, 0)
         eoddata = fh.read()
         iEND = eoddata.find(b'PK\x05\x06')
         if iEND==-1:
-            print("expected PK0506 - probably not a PKZIP file")
-            return
+            raise BadZipError("expected PK0506 - probably not a PKZIP file")
     else:
-        ofs = fh.tell()-0x100
+        ofs = fsize-100
     eod = EndOfCentralDir(ofs, eoddata, iEND+4)
     yield eod
 
@@ -414,40 +436,157 @@ def quickScanZip(args, fh):
         fh.seek(dirofs)
         dirdata = fh.read(46)
         if dirdata[:4] != b'PK\x01\x02':
-            print("expected PK0102")
-            return
+            raise BadZipError("expected PK0102")
         dirent = CentralDirEntry(dirofs, dirdata, 4)
 
         yield dirent
         dirofs = dirent.endOffset
 
-def zipraw(fh, ent):
-    if isinstance(ent, CentralDirEntry):
-        # find LocalFileHeader
-        fh.seek(ent.dataOfs)
-        data = fh.read(4+LocalFileHeader.HeaderSize)
-        dirent = ent
-        ent = LocalFileHeader(ent.dataOfs, data, 4)
-
-        ent.loaditems(fh)
-
-    fh.seek(ent.dataOffset)
-    nread = 0
+def localheader(fh, ent):
+    """ returns the LocalFileHeader for a CentralDirEntry. """
+    if not isinstance(ent, CentralDirEntry):
+        return ent
+    fh.seek(ent.dataOfs)
+    data = fh.read(4+LocalFileHeader.HeaderSize)
+    dirent = ent
+    ent = LocalFileHeader(ent.dataOfs, data, 4)
+
+    ent.loaditems(fh)
+    if ent.flags&8:
+        # the crc and sizes are in the DataDescriptor, use those from the directory
+        ent.crc32 = dirent.crc32
+        ent.compressedSize = dirent.compressedSize
+        ent.originalSize = dirent.originalSize
+        ent.sizesKnown = True
+    return ent
+
+def sizesknown(ent):
+    """ False when the sizes and crc of <ent> are only in the DataDescriptor following its data. """
+    # sizesKnown is set when copied from the directory, or read from the DataDescriptor.
+    return not ent.flags&8 or isinstance(ent, CentralDirEntry) or getattr(ent, "sizesKnown", False)
+
+def zipraw(fh, ent, ofs=0):
+    """ yields the raw data of <ent>, starting at <ofs> """
+    ent = localheader(fh, ent)
+
+    nread = ofs
     while nread < ent.compressedSize:
         want = min(ent.compressedSize-nread, 0x10000)
+        # seek for each block, the caller may use fh in between.
+        fh.seek(ent.dataOffset + nread)
         block = fh.read(want)
         if len(block)==0:
             break
         yield block
         nread += len(block)
 
-def blockdump(baseofs, blks):
-    o = baseofs
+def byterange(blks, ofs, size=None):
+    """
+    yields <size> bytes starting at <ofs> from a stream of byte blocks,
+    size=None: until the end of the stream.
+    """
+    for blk in blks:
+        if ofs >= len(blk):
+            ofs -= len(blk)
+            continue
+        blk = blk[ofs:]
+        ofs = 0
+        if size is not None:
+            blk = blk[:size]
+            size -= len(blk)
+        yield blk
+        if size == 0:
+            break
+
+# maps all bytes to themselves, except non printable bytes to '.'
+HEXDUMPASCII = bytes(c if 0x20 <= c < 0x7f else 0x2e for c in range(256))
+
+def hexdump(out, baseofs, blks, width=16):
+    """
+    Write a hexdump of a stream of byte blocks to the binary writer <out>.
+    Each line has the offset, <width> hex bytes, and the ascii characters,
+    a sequence of identical lines is collapsed into a single '*'.
+
+    Each block is formatted into a single batch, and written with one write.
+    """
+    hexwidth = 3*width-1
+    state = { "prev": None, "collapsed": False }
+
+    def formatlines(ofs, data):
+        """ format line by line, collapsing repeated lines """
+        hexs = binascii.hexlify(data, b' ')
+        text = data.translate(HEXDUMPASCII)
+        prev = state["prev"]
+        collapsed = state["collapsed"]
+        lines = []
+        for i in range(0, len(data), width):
+            line = data[i:i+width]
+            if line == prev:
+                if not collapsed:
+                    lines.append(b"*\n")
+                    collapsed = True
+                continue
+            prev = line
+            collapsed = False
+            lines.append(b"%08x: %-*s  %s\n" % (ofs+i, hexwidth, hexs[3*i:3*i+hexwidth], text[i:i+width]))
+        state["prev"] = prev
+        state["collapsed"] = collapsed
+        return b"".join(lines)
+
+    def formatcolumns(ofs, data):
+        """
+        format a multiple of <width> bytes without repeated lines: instead of
+        formatting each line, each column of the output is filled for all lines
+        with a single slice assignment.
+        """
+        nlines = len(data) // width
+        digits = len("%08x" % (ofs+len(data)-width))
+        linesize = digits + 4*width + 4
+        lines = bytearray(b' ') * (linesize * nlines)
+        offsets = binascii.hexlify(struct.pack(">%dQ" % nlines, *range(ofs, ofs+len(data), width)))
+        for c in range(digits):
+            lines[c::linesize] = offsets[16-digits+c::16]
+        lines[digits::linesize] = b':' * nlines
+        hexs = binascii.hexlify(data, b' ')
+        for c in range(hexwidth):
+            lines[digits+2+c::linesize] = hexs[c::3*width]
+        text = data.translate(HEXDUMPASCII)
+        for c in range(width):
+            lines[linesize-1-width+c::linesize] = text[c::width]
+        lines[linesize-1::linesize] = b'\n' * nlines
+        state["prev"] = data[-width:]
+        state["collapsed"] = False
+        return lines
+
+    def hasrepeats(data):
+        """ quick check for repeated lines, by looking for <width> zeros in data xor (data shifted by one line). """
+        if data[:width] == state["prev"]:
+            return True
+        diff = int.from_bytes(data[width:], 'little') ^ int.from_bytes(data[:-width], 'little')
+        return bytes(width) in diff.to_bytes(len(data)-width, 'little')
+
+    ofs = baseofs
+    pending = b''
     for blk in blks:
-        print("%08x: %s" % (o, binascii.b2a_hex(blk)))
-        o += len(blk)
+        data = pending + blk if pending else blk
+        n = len(data) - len(data) % width
+        if n:
+            chunk = data[:n]
+            if len("%08x" % ofs) == len("%08x" % (ofs+n-width)) and not hasrepeats(chunk):
+                out.write(formatcolumns(ofs, chunk))
+            else:
+                out.write(formatlines(ofs, chunk))
+        pending = data[n:]
+        ofs += n
+    if pending:
+        out.write(formatlines(ofs, pending))
+        ofs += len(pending)
+    if state["collapsed"]:
+        out.write(b"%08x\n" % ofs)
+    out.flush()
 
 def zipcat(blks, ent):
+    import zlib
     if ent.method==8:
         C = zlib.decompressobj(-15)
         for block in blks:
@@ -459,7 +598,244 @@ def zipcat(blks, ent):
         print("unknown compression method")
 
 
+class StreamedEntry(object):
+    """
+    Push style decoder for the data following a LocalFileHeader, for use on
+    forward-only streams.  When flag bit 3 is set, the sizes are only known
+    from the DataDescriptor following the data, then deflated data is
+    inflated until the end of the deflate stream.
+
+    feed() returns the number of bytes consumed, when 'done' is set, the
+    remaining bytes belong to what follows the entry.
+    'onraw' and 'ondata' receive the raw and the decompressed data.
+
+    With trustsize=False, deflated data is always inflated until the end of
+    the stream, ignoring the compressed size from the header.
+    """
+    def __init__(self, ent, password=None, decompress=False, trustsize=True):
+        import zlib
+        self.ent = ent
+        self.trustsize = trustsize
+        self.onraw = None
+        self.ondata = None
+        self.decryptor = ZipDecryptor(password) if password and ent.flags&1 else None
+        self.cryptskip = 12 if self.decryptor else 0
+        self.inflater = None
+        if ent.flags&1 and not self.decryptor:
+            decompress = False
+        if ent.method==8 and (decompress or ent.flags&8) and not (ent.flags&1 and not self.decryptor):
+            self.inflater = zlib.decompressobj(-15)
+        self.decompress = bool(decompress or self.inflater)
+
+        self.rawsize = 0        # nr of raw bytes consumed
+        self.crc = 0
+        self.size = 0           # nr of decompressed bytes
+        self.pending = b''      # stored data, held back while searching for the data descriptor
+        self.descriptor = None
+        self.error = None
+        self.done = False
+
+        if self.decompress and ent.method not in (0, 8):
+            self.decompress = False
+            self.error = "unknown compression method %d" % ent.method
+
+        if self.knownsize():
+            self.state = 'data'
+        elif ent.flags&1 and not self.decryptor:
+            self.state = 'error'
+            self.error = "encrypted entry with data descriptor needs a password"
+        elif ent.method==8:
+            self.state = 'data'
+        elif ent.method==0:
+            self.state = 'stored'
+        else:
+            self.state = 'error'
+            self.error = "can't find the end of method %d data" % ent.method
+        if self.state == 'error':
+            self.done = True
+        elif self.state == 'data' and self.knownsize() and not ent.flags&8 and ent.compressedSize==0:
+            self.finish()
+
+    def knownsize(self):
+        if self.inflater and not self.trustsize:
+            return False
+        if not self.ent.flags&8 or getattr(self.ent, "sizesKnown", False):
+            return True
+        # some archivers set flag bit 3, and still store the sizes in the header, but
+        # Info-ZIP leaves out the encryption header for stored entries.  So these are
+        # only used when the end can't be found otherwise.
+        return self.ent.compressedSize and self.ent.flags&1 and not self.decryptor
+
+    def feed(self, data):
+        used = 0
+        while not self.done:
+            state = self.state
+            n = self.feedstate(data[used:])
+            used += n
+            if n == 0 and self.state == state:
+                break
+        return used
+
+    def feedstate(self, data):
+        if self.state == 'data':
+            if not self.knownsize():
+                return self.process(data)
+            want = min(len(data), self.ent.compressedSize - self.rawsize)
+            n = self.process(data[:want])
+            if self.rawsize == self.ent.compressedSize:
+                if self.ent.flags&8:
+                    self.state = 'descriptor'
+                else:
+                    self.finish()
+            return n
+        elif self.state == 'stored':
+            return self.findstoredend(data)
+        elif self.state == 'descriptor':
+            return self.readdescriptor(data)
+        return 0
+
+    def process(self, raw):
+        """ decrypt and decompress raw data, returns the number of bytes used. """
+        import zlib
+        used = len(raw)
+        ended = False
+        if self.decompress:
+            data = raw
+            if self.decryptor:
+                data = bytes(self.decryptor.decrypt(raw))
+                if self.cryptskip:
+                    skip = min(self.cryptskip, len(data))
+                    data = data[skip:]
+                    self.cryptskip -= skip
+            if self.inflater:
+                try:
+                    data = self.inflater.decompress(data)
+                except zlib.error as e:
+                    self.error = "%s" % e
+                    self.state = 'error'
+                    self.done = True
+                    return len(raw)
+                if self.inflater.eof and not self.knownsize():
+                    # the descriptor, or the next header, follows the deflate stream
+                    used = len(raw) - len(self.inflater.unused_data)
+                    ended = True
+            self.crc = zlib.crc32(data, self.crc)
+            self.size += len(data)
+            if self.ondata and data:
+                self.ondata(data)
+        if self.onraw and used:
+            self.onraw(raw[:used])
+        self.rawsize += used
+        if ended:
+            if self.ent.flags&8:
+                self.state = 'descriptor'
+            else:
+                self.finish()
+        return used
+
+    def findstoredend(self, data):
+        """
+        Stored data with a descriptor: the end is found by searching for
+        a signed descriptor with a matching compressed size.
+        """
+        buf = self.pending + data
+        i = -1
+        while True:
+            i = buf.find(b'PK\x07\x08', i+1)
+            if i == -1 or i+16 > len(buf):
+                break
+            if DataDescriptor.HeaderStruct.unpack_from(buf, i+4)[1] == self.rawsize + i:
+                self.process(buf[:i])
+                self.state = 'descriptor'
+                # part of the descriptor may already be in the held back bytes
+                held = len(self.pending)
+                self.pending = buf[i:held]
+                return max(i - held, 0)
+        # hold back enough bytes for a partial descriptor
+        keep = min(len(buf), 15) if i == -1 else len(buf) - i
+        self.process(buf[:len(buf)-keep])
+        self.pending = buf[len(buf)-keep:]
+        return len(data)
+
+    def readdescriptor(self, data):
+        """ read the 12 byte descriptor, optionally preceded by a signature """
+        buf = self.pending + data
+        if len(buf) < 4:
+            self.pending = buf
+            return len(data)
+        size = 16 if buf[:4] == b'PK\x07\x08' else 12
+        if len(buf) < size:
+            self.pending = buf
+            return len(data)
+        self.descriptor = DataDescriptor(self.ent.dataOffset + self.rawsize + size-12, buf[size-12:size], 0)
+        self.ent.crc32 = self.descriptor.crc
+        self.ent.compressedSize = self.descriptor.compSize
+        self.ent.originalSize = self.descriptor.uncompSize
+        self.ent.sizesKnown = True
+        self.finish()
+        used = size - len(self.pending)
+        self.pending = b''
+        return used
+
+    def finish(self):
+        import zlib
+        if self.inflater and not self.inflater.eof and not self.error:
+            data = self.inflater.flush()
+            self.crc = zlib.crc32(data, self.crc)
+            self.size += len(data)
+            if self.ondata and data:
+                self.ondata(data)
+        self.state = 'done'
+        self.done = True
+
+    def crcok(self):
+        return self.decompress and not self.error and self.crc == self.ent.crc32
+
+
+def entryblocks(fh, ent, password=None, decompress=True):
+    """
+    yields the decrypted and decompressed data of <ent>, or with decompress=False the raw data,
+    using a StreamedEntry, so this also works when the sizes are only in the DataDescriptor.
+    Raises ValueError when the data can not be decoded, is truncated, or has a bad crc.
+    The crc and sizes from the DataDescriptor are only stored in <ent> after the crc matched.
+    """
+    import copy
+    ent = localheader(fh, ent)
+    # with a wrong password the DataDescriptor found is garbage, so decode using a copy of the header.
+    hdr = copy.copy(ent)
+    entry = StreamedEntry(hdr, password, decompress)
+    if entry.error:
+        raise ValueError("%s: %s" % (ent.name, entry.error))
+    if decompress and not entry.decompress:
+        raise ValueError("%s is encrypted, and no password was specified" % ent.name)
+    blks = []
+    if decompress:
+        entry.ondata = blks.append
+    else:
+        entry.onraw = blks.append
+    pos = ent.dataOffset
+    while not entry.done:
+        # seek for each block, the caller may use fh in between.
+        fh.seek(pos)
+        data = fh.read(0x10000)
+        if not data:
+            break
+        pos += entry.feed(data)
+        yield from blks
+        del blks[:]
+    if entry.error:
+        raise ValueError("%s: %s" % (ent.name, entry.error))
+    if not entry.done:
+        raise ValueError("%s: truncated" % ent.name)
+    if decompress and not entry.crcok():
+        raise ValueError("%s: bad crc" % ent.name)
+    if entry.descriptor and (entry.crcok() or not entry.decompress):
+        ent.crc32, ent.compressedSize, ent.originalSize = hdr.crc32, hdr.compressedSize, hdr.originalSize
+        ent.sizesKnown = True
+
+
 def namegenerator(name):
+    import itertools
     yield name
     paths = name.rsplit('/', 1)
     parts = paths[-1].rsplit('.', 1)
@@ -477,25 +853,863 @@ def namegenerator(name):
     for i in itertools.count(1):
         yield "%s-%d%s" % (part0, i, part1)
 
-def savefile(outdir, name, data):
-    os.makedirs(os.path.dirname(os.path.join(outdir, name)), exist_ok=True)
-    for namei in namegenerator(name):
-        path = os.path.join(outdir, namei)
-        if not os.path.exists(path):
+class OutputDir(object):
+    """
+    Hands out unused names in the output directory, without probing each candidate.
+    Each directory is listed once, names are only reserved after the file was created,
+    a name taken by another process in the meantime is skipped.
+    processfile uses a new OutputDir for each archive.
+    """
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.listed = {}        # dirname -> names in the directory
+        self.reserved = {}      # dirname -> names created for this archive
+
+    def listdir(self, dirname):
+        names = self.listed.get(dirname)
+        if names is None:
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            names = self.listed[dirname] = set(os.listdir(dirname or "."))
+        return names
+
+    def candidates(self, name):
+        """
+        yields (path, exists) for the names derived from <name> which were not created
+        for this archive yet, creating the directories leading to it.
+        """
+        dirname, name = os.path.split(os.path.join(self.outdir, name))
+        if not name:
+            raise ValueError("empty filename")
+        listed = self.listdir(dirname)
+        reserved = self.reserved.setdefault(dirname, set())
+        for namei in namegenerator(name):
+            if namei not in reserved:
+                yield os.path.join(dirname, namei), namei in listed
+
+    def unused(self, name):
+        """ returns a path for <name> which does not exist yet. """
+        for path, exists in self.candidates(name):
+            if not exists:
+                return path
+
+    def reserve(self, path):
+        dirname, name = os.path.split(path)
+        self.listdir(dirname).add(name)
+        self.reserved.setdefault(dirname, set()).add(name)
+
+    def makedir(self, name):
+        """ create the directory for a directory entry """
+        os.makedirs(os.path.join(self.outdir, name), exist_ok=True)
+
+    def taken(self, path):
+        """ <path> was created by another process after the directory was listed """
+        self.listdir(os.path.dirname(path)).add(os.path.basename(path))
+
+    def createpart(self, name):
+        """
+        returns an unused path for <name>, and <path>.part opened for writing.
+        The path is reserved, finishpart renames the .part file after the crc was verified.
+        """
+        path = self.unused(name)
+        fh = open(path + ".part", "wb")
+        self.reserve(path)
+        return path, fh
+
+    def finishpart(self, path, ent, ok):
+        """
+        rename <path>.part to <path> when <ok>.  When a file with the size and crc of <ent>
+        already exists, that is kept instead.  Returns False when the data was left in the .part file.
+        """
+        part = path + ".part"
+        if not ok:
+            return False
+        for existing, exists in self.candidates(ent.name):
+            if not exists:
+                break
+            if samefile(existing, ent):
+                os.remove(part)
+                dirname, name = os.path.split(path)
+                self.reserved[dirname].discard(name)
+                self.listed[dirname].discard(name)
+                self.reserve(existing)
+                return True
+        try:
+            renamenew(part, path)
+        except FileExistsError:
+            return False
+        return True
+
+
+class ExtractStore(object):
+    """
+    Content addressed store for extracted files, shared between runs.
+
+    Blobs are keyed by (crc32, originalSize, compressedSize, method), all known
+    from the directory entry, so an entry already in the store is hardlinked
+    into the output directory without fetching or decompressing its data.
+    The set of stored keys is kept in index.json in the store directory.
+    """
+    def __init__(self, path):
+        import json
+        self.path = path
+        self.indexpath = os.path.join(path, "index.json")
+        os.makedirs(path, exist_ok=True)
+        try:
+            with open(self.indexpath, "r") as fh:
+                self.index = json.load(fh)
+        except (IOError, ValueError):
+            self.index = {}
+        self.added = {}
+        self.reused = 0
+
+    @staticmethod
+    def key(ent):
+        if ent.flags&8 and not ent.compressedSize:
+            # sizes are only known from the DataDescriptor
+            return None
+        return "%08x-%d-%d-%d" % (ent.crc32, ent.originalSize, ent.compressedSize, ent.method)
+
+    def blobpath(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def link(self, src, output, name):
+        """ hardlink <src> to an unused path for <name> in the OutputDir <output>. """
+        while True:
+            dst = output.unused(name)
+            try:
+                os.link(src, dst)
+            except FileExistsError:
+                output.taken(dst)
+                continue
+            except OSError:
+                # different filesystem, or no hardlink support
+                import shutil
+                with open(src, "rb") as ifh:
+                    try:
+                        ofh = open(dst, "xb")
+                    except FileExistsError:
+                        output.taken(dst)
+                        continue
+                    with ofh:
+                        shutil.copyfileobj(ifh, ofh)
+            output.reserve(dst)
+            return
+
+    def extract(self, key, output, name):
+        """ link a stored blob to <name>, returns False when <key> is not in the store. """
+        if key not in self.index and key not in self.added:
+            return False
+        try:
+            self.link(self.blobpath(key), output, name)
+        except (IOError, OSError):
+            # blob was removed from the store
+            self.index.pop(key, None)
+            self.added.pop(key, None)
+            return False
+        self.reused += 1
+        return True
+
+    def add(self, key, path, name):
+        """ add the extracted, crc verified, file <path> to the store. """
+        blob = self.blobpath(key)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tmp = "%s.%d.tmp" % (blob, os.getpid())
+        try:
+            os.link(path, tmp)
+        except OSError:
+            import shutil
+            shutil.copyfile(path, tmp)
+        os.replace(tmp, blob)
+        self.added[key] = name
+
+    def close(self):
+        """ merge the new keys into the index, which may have been updated by another process. """
+        import json
+        if not self.added:
+            return
+        try:
+            with open(self.indexpath, "r") as fh:
+                index = json.load(fh)
+        except (IOError, ValueError):
+            index = {}
+        index.update(self.added)
+        tmp = "%s.%d.tmp" % (self.indexpath, os.getpid())
+        with open(tmp, "w") as fh:
+            json.dump(index, fh, indent=0, sort_keys=True)
+        os.replace(tmp, self.indexpath)
+        self.index = index
+        self.added = {}
+
+
+def islocal(fh):
+    """ True when <fh> is a regular file, and not a url or pipe. """
+    import stat
+    try:
+        return stat.S_ISREG(os.fstat(fh.fileno()).st_mode)
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+
+def copyrange(src, dst, ofs, size):
+    """
+    copy <size> bytes at <ofs> from fd <src> to the current position of fd <dst>,
+    using copy_file_range or sendfile, so the data is not copied to userspace.
+    """
+    while size > 0:
+        try:
+            n = os.copy_file_range(src, dst, size, ofs)
+        except (AttributeError, OSError):
+            try:
+                n = os.sendfile(dst, src, ofs, size)
+            except (AttributeError, OSError):
+                n = os.write(dst, os.pread(src, min(size, 0x100000), ofs))
+        if n == 0:
             break
-    with open(path, "wb") as fh:
-        fh.writelines(data)
+        ofs += n
+        size -= n
+
+def copyraw(fh, ent, path):
+    """ copy the raw data of <ent> to <path>, continuing after the data already in <path>. """
+    with open(path, "r+b" if os.path.exists(path) else "wb") as ofh:
+        have = ofh.seek(0, os.SEEK_END)
+        if have > ent.compressedSize:
+            ofh.truncate(0)
+            have = ofh.seek(0)
+        todo = ent.compressedSize - have
+        if islocal(fh):
+            copyrange(fh.fileno(), ofh.fileno(), ent.dataOffset + have, todo)
+            return
+        # for urlstream this results in a Range request starting at the first missing byte.
+        fh.seek(ent.dataOffset + have)
+        while todo > 0:
+            blk = fh.read(min(todo, 0x100000))
+            if not blk:
+                break
+            ofh.write(blk)
+            todo -= len(blk)
+
+def readblocks(path):
+    with open(path, "rb") as fh:
+        while True:
+            blk = fh.read(0x100000)
+            if not blk:
+                break
+            yield blk
+
+def samefile(path, ent):
+    """ True when <path> has the size and crc of <ent>. """
+    import zlib
+    if not sizesknown(ent):
+        return False
+    try:
+        if os.path.getsize(path) != ent.originalSize:
+            return False
+    except OSError:
+        return False
+    crc = 0
+    for blk in readblocks(path):
+        crc = zlib.crc32(blk, crc)
+    return crc == ent.crc32
+
+def renamenew(src, dst):
+    """ rename <src> to <dst>, raises FileExistsError instead of replacing an existing <dst>. """
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        raise
+    except OSError:
+        # no hardlink support
+        if os.path.exists(dst):
+            raise FileExistsError(dst)
+        os.rename(src, dst)
+        return
+    os.remove(src)
+
+def extractpart(args, fh, ent, part, rawpart):
+    """ extract <ent> to <part>, via <rawpart> when specified, returns the crc, or None. """
+    import zlib
+    if ent.method == 0 and not ent.flags&1 and sizesknown(ent):
+        copyraw(fh, ent, part)
+        crc = 0
+        for blk in readblocks(part):
+            crc = zlib.crc32(blk, crc)
+        return crc
+
+    if not sizesknown(ent):
+        # the end of the data is found while decoding, this also sets the crc from the DataDescriptor.
+        blks = entryblocks(fh, ent, args.password)
+    else:
+        if rawpart:
+            copyraw(fh, ent, rawpart)
+            blks = readblocks(rawpart)
+        else:
+            blks = zipraw(fh, ent)
+        if args.password and ent.flags&1:
+            blks = skipbytes(zip_decrypt(blks, args.password), 12, args)
+        blks = zipcat(blks, ent)
+    crc = 0
+    with open(part, "wb") as ofh:
+        try:
+            for blk in blks:
+                ofh.write(blk)
+                crc = zlib.crc32(blk, crc)
+        except (zlib.error, ValueError) as e:
+            print("%s: %s" % (ent.name, e), file=sys.stderr)
+            crc = None
+    return crc
+
+def extractfile(args, fh, ent, path):
+    """
+    Extract <ent> to <path>.part, which is renamed to <path> after verifying the crc.
+    An interrupted extraction is resumed:
+     * stored entries continue at the end of the .part file, for urls using a Range request.
+     * other entries from urls are first downloaded to <path>.raw.part, which is
+       resumed the same way, and then decrypted and decompressed locally.
+    When the resumed data has the wrong crc, it is removed, and the entry extracted again.
+    Stored entries from local files are copied with copy_file_range or sendfile.
+    An existing <path> is never replaced, when it has the right size and crc it is kept.
+    Returns True when the crc matched.
+    """
+    ent = localheader(fh, ent)
+    if os.path.exists(path):
+        if samefile(path, ent):
+            return True
+        print("%s: %s already exists" % (ent.name, path), file=sys.stderr)
+        return False
+
+    part = path + ".part"
+    rawpart = None
+    if not sizesknown(ent):
+        resumefile = None
+    elif ent.method == 0 and not ent.flags&1:
+        resumefile = part
+    elif not islocal(fh):
+        resumefile = rawpart = path + ".raw.part"
+    else:
+        resumefile = None
+
+    resumed = resumefile and os.path.exists(resumefile)
+    crc = extractpart(args, fh, ent, part, rawpart)
+    if crc != ent.crc32 and resumed:
+        # left by an extraction of another entry, or a different version of the archive.
+        print("%s: CRC ERROR in resumed %s, extracting again" % (ent.name, resumefile), file=sys.stderr)
+        os.remove(resumefile)
+        crc = extractpart(args, fh, ent, part, rawpart)
+
+    if crc != ent.crc32:
+        print("%s: CRC ERROR, data left in %s" % (ent.name, part), file=sys.stderr)
+        return False
+    try:
+        renamenew(part, path)
+    except FileExistsError:
+        print("%s: %s was created by another process, data left in %s" % (ent.name, path, part), file=sys.stderr)
+        return False
+    if rawpart:
+        os.remove(rawpart)
+    return True
+
+def saveentry(args, fh, ent):
+    """
+    extract <ent> to the output directory, using the --store when specified.
+    Files with the size and crc of <ent> already in the output directory are kept,
+    so running the same command again only extracts the missing entries.
+    """
+    output = args.output
+    if ent.name.endswith('/'):
+        output.makedir(ent.name)
+        return
+    for path, exists in output.candidates(ent.name):
+        if not exists:
+            break
+        if not sizesknown(ent):
+            # decode the entry once, to get the crc and sizes from the DataDescriptor
+            try:
+                for _ in entryblocks(fh, ent, args.password):
+                    pass
+            except ValueError:
+                pass
+        if samefile(path, ent):
+            output.reserve(path)
+            return
+    store = args.store
+    key = store and store.key(ent)
+    if key and store.extract(key, output, ent.name):
+        return
+    ok = extractfile(args, fh, ent, path)
+    # also on failure, the name stays with the .part file of this entry.
+    output.reserve(path)
+    if ok and key:
+        store.add(key, path, ent.name)
 
 def getbytes(fh, ofs, size):
     fh.seek(ofs)
     return fh.read(size)
+
+def recoverpassword(args, fh, ent):
+    """
+    Test the candidates from --password-list against the encryption header of <ent>,
+    survivors are verified by decrypting, decompressing and checking the crc.
+    """
+    import zipcrack
+    import zlib
+
+    ent = localheader(fh, ent)
+
+    def verify(pw):
+        # cheap check on a small prefix first: most false positives are not valid deflate data.
+        prefix, _ = zipcrack.decryptbytes(zipcrack.initkeys(pw), getbytes(fh, ent.dataOffset, 0x400))
+        if ent.method==8:
+            try:
+                zlib.decompressobj(-15).decompress(bytes(prefix[12:]))
+            except zlib.error:
+                return False
+        try:
+            for _ in entryblocks(fh, ent, pw):
+                pass
+        except ValueError:
+            return False
+        return True
+
+    # read the header directly, with a DataDescriptor the size in the LocalFileHeader may be zero.
+    header = getbytes(fh, ent.dataOffset, 12)
+    if len(header) < 12:
+        print("%s: encryption header truncated" % ent.name)
+        return
+    with open(args.password_list, "rb") as wfh:
+        pw = zipcrack.findpassword(header, zipcrack.checkbyte(ent), zipcrack.readwordlist(wfh, 0x4000), verify, args.jobs)
+    # on stderr, stdout may be used for --cat or --raw output
+    if pw is None:
+        print("%s: password not found" % ent.name, file=sys.stderr)
+    else:
+        print("PASSWORD: %s  ( hex: %s )" % (pw.decode('utf-8', 'replace'), binascii.b2a_hex(pw).decode('ascii')), file=sys.stderr)
+    return pw
+
+def knownplaintextattack(args, fh, ent):
+    """
+    Recover the internal keys of <ent> using the known plaintext from --plaintext or --plaintext-hex.
+    """
+    import zipcrack
+
+    if args.plaintext:
+        with open(args.plaintext, "rb") as pfh:
+            plaintext = pfh.read()
+    else:
+        plaintext = binascii.a2b_hex(args.plaintext_hex)
+
+    # the plaintext is located after the 12 byte encryption header
+    offset = 12 + args.plaintext_offset
+    size = offset + len(plaintext)
+    ent = localheader(fh, ent)
+    if sizesknown(ent):
+        size = min(size, ent.compressedSize)
+    # with a DataDescriptor the size in the LocalFileHeader can't be trusted, read the bytes directly.
+    ciphertext = getbytes(fh, ent.dataOffset, size)
+
+    def log(msg):
+        sys.stderr.write("\r" + msg)
+        sys.stderr.flush()
+
+    try:
+        keys = zipcrack.recoverkeys(ciphertext, plaintext, offset, args.jobs, log if not args.quiet else None)
+    except ValueError as e:
+        print("%s: %s" % (ent.name, e), file=sys.stderr)
+        return
+    if not args.quiet:
+        sys.stderr.write("\n")
+    if keys is None:
+        print("%s: keys not found" % ent.name, file=sys.stderr)
+        return
+    print("KEYS: %s" % ",".join("0x%08x" % k for k in keys), file=sys.stderr)
+    return list(keys)
     
+def processstream(args, fh):
+    """
+    Process a zip from a forward-only stream, in a single pass.
+    Only the LocalFileHeaders are used, processing stops at the central directory.
+    """
+    def checkarg(arg, ent):
+        if not arg:
+            return False
+        return '*' in arg or  ent.name in arg
+
+    buf = b''
+    bufofs = 0      # file offset of buf[0]
+    entry = None
+    output = None
+    outpath = None
+    while True:
+        if entry:
+            n = entry.feed(buf)
+            buf = buf[n:]
+            bufofs += n
+            if entry.done:
+                ent = entry.ent
+                status = ""
+                if entry.error:
+                    status = "ERROR: %s" % entry.error
+                elif entry.decompress and not entry.crcok():
+                    status = "CRC ERROR"
+                elif args.verify:
+                    status = "OK" if entry.decompress else "not verified, encrypted"
+                if output:
+                    output.close()
+                    output = None
+                    if not args.output.finishpart(outpath, ent, entry.crcok()):
+                        status = "%s, data left in %s.part" % (status or "not saved", outpath)
+                if args.cat or args.raw or args.save:
+                    if status and status != "OK":
+                        sys.stderr.write("%s: %s\n" % (ent.name, status))
+                else:
+                    if args.verbose:
+                        print("%08x: %s" % (ent.pkOffset, ent))
+                        if entry.descriptor:
+                            print("%08x: %s" % (ent.dataOffset + entry.rawsize, entry.descriptor))
+                    else:
+                        print(ent.summary())
+                    if status:
+                        print("    %s" % status)
+                entry = None
+                continue
+        elif len(buf) >= 4:
+            if buf[:4] != b'PK\x03\x04':
+                if buf[:4] not in (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06', b'PK\x05\x05'):
+                    print("%08x: expected PK0304" % bufofs)
+                break
+            if len(buf) >= 4+LocalFileHeader.HeaderSize:
+                ent = LocalFileHeader(bufofs, buf, 4)
+                hdrsize = ent.dataOffset - bufofs
+                if len(buf) >= hdrsize:
+                    ent.name = decode_name(buf[ent.nameOffset-bufofs:ent.extraOffset-bufofs])
+                    ent.extra = buf[ent.extraOffset-bufofs:hdrsize]
+                    buf = buf[hdrsize:]
+                    bufofs += hdrsize
+
+                    do_cat = checkarg(args.cat, ent)
+                    do_raw = checkarg(args.raw, ent)
+                    do_save= checkarg(args.save, ent)
+                    entry = StreamedEntry(ent, args.password, do_cat or do_save or args.verify)
+                    if do_cat:
+                        entry.ondata = sys.stdout.buffer.write
+                    if do_raw:
+                        entry.onraw = sys.stdout.buffer.write
+                    if do_save and ent.name.endswith('/'):
+                        args.output.makedir(ent.name)
+                    elif do_save and not entry.decompress:
+                        if not entry.error:
+                            sys.stderr.write("%s: not extracted, encrypted\n" % ent.name)
+                    elif do_save:
+                        outpath, output = args.output.createpart(ent.name)
+                        entry.ondata = output.write
+                    continue
+
+        data = fh.read(args.chunksize)
+        if not data:
+            if entry:
+                print("%s: truncated" % entry.ent.name)
+            break
+        buf += data
+    if output:
+        output.close()
+
+class CarvedEntry(object):
+    """
+    Recovers one entry found by findPKHeaders: collects the name and extra field,
+    then passes the data to a StreamedEntry, and saves the decompressed data.
+    The data is written to NAME.part, which is only renamed when the crc matched,
+    and removed after a decoding error.
+    """
+    def __init__(self, args, ent):
+        self.args = args
+        self.ent = ent
+        self.pos = ent.nameOffset       # file offset of the next byte needed
+        self.header = b''
+        self.entry = None
+        self.output = None
+        self.outpath = None
+        self.done = False
+
+    @staticmethod
+    def plausible(ent):
+        """ filter out most random PK0304 occurrences """
+        return ent.method in (0, 8) and 0 < ent.nameLength <= 1024 and not ent.flags&64
+
+    def feed(self, base, data):
+        """ feed a chunk starting at file offset <base>, only the part from self.pos is used. """
+        data = data[self.pos-base:]
+        if self.entry is None:
+            hdrsize = self.ent.nameLength + self.ent.extraLength
+            want = hdrsize - len(self.header)
+            self.header += data[:want]
+            self.pos += len(data[:want])
+            data = data[want:]
+            if len(self.header) < hdrsize:
+                return
+            self.ent.name = decode_name(self.header[:self.ent.nameLength])
+            self.ent.extra = self.header[self.ent.nameLength:]
+            self.header = None
+            self.entry = StreamedEntry(self.ent, self.args.password, True, trustsize=False)
+            self.entry.ondata = self.write
+        if not self.entry.done:
+            self.pos += self.entry.feed(data)
+        if self.entry.done:
+            self.finish()
+
+    def write(self, data):
+        if self.ent.name.endswith('/'):
+            return
+        if not self.output:
+            self.outpath, self.output = self.args.output.createpart(self.ent.name)
+        self.output.write(data)
+
+    def finish(self):
+        if self.entry and self.entry.done and self.entry.decompress and not self.entry.error:
+            if self.ent.name.endswith('/'):
+                self.args.output.makedir(self.ent.name)
+            elif not self.output:
+                # empty entry
+                self.outpath, self.output = self.args.output.createpart(self.ent.name)
+            # the header sizes may be garbage in damaged archives
+            self.ent.compressedSize = self.entry.rawsize
+            self.ent.originalSize = self.entry.size
+        if self.output:
+            self.output.close()
+            self.output = None
+            if self.entry and self.entry.error:
+                # how much was written before a decoding error depends on the --chunksize
+                os.remove(self.outpath + ".part")
+            else:
+                self.args.output.finishpart(self.outpath, self.ent, self.status()=="OK")
+        self.done = True
+
+    def status(self):
+        if self.entry is None or not self.entry.done:
+            return "truncated"
+        if self.entry.error:
+            return "ERROR: %s" % self.entry.error
+        if not self.entry.decompress:
+            return "not extracted, encrypted"
+        return "OK" if self.entry.crcok() else "CRC ERROR"
+
+
+def carvefile(args, fh):
+    """
+    Recover entries from damaged archives and disk images in a single sequential pass.
+
+    Each LocalFileHeader found by findPKHeaders starts a CarvedEntry, which is fed
+    the data following it, deflated data is inflated until the end of the deflate
+    stream, and matched with the DataDescriptor following it.
+    """
+    carvers = []
+    current = []
+    counts = {}
+
+    def report(c):
+        status = c.status()
+        counts[status=="OK"] = counts.get(status=="OK", 0) + 1
+        if c.entry:
+            print("%08x: %s  %s" % (c.ent.pkOffset, c.ent.summary(), status))
+        else:
+            print("%08x: %s" % (c.ent.pkOffset, status))
+
+    def onchunk(base, data):
+        current[:] = [base, data]
+        for c in carvers:
+            c.feed(base, data)
+            if c.done:
+                report(c)
+        carvers[:] = [ c for c in carvers if not c.done ]
+
+    for ent in findPKHeaders(args, fh, onchunk):
+        if isinstance(ent, LocalFileHeader) and CarvedEntry.plausible(ent):
+            c = CarvedEntry(args, ent)
+            c.feed(*current)
+            if c.done:
+                report(c)
+            else:
+                carvers.append(c)
+    for c in carvers:
+        c.finish()
+        report(c)
+    print("carved %d entries, %d with errors" % (counts.get(True, 0), counts.get(False, 0)))
+
+def openfile(fn):
+    """ Open a file or url. """
+    if fn.find("://") in (3,4,5):
+        # when argument looks like a url, use urlstream to open
+        import urlstream
+        return urlstream.open(fn)
+    return open(fn, "rb")
+
+
+class EntryReader(io.RawIOBase):
+    """ Read only file object, reading from a generator of byte blocks. """
+    def __init__(self, blks):
+        super(EntryReader, self).__init__()
+        self.blks = blks
+        self.buf = b''
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.pos >= len(self.buf):
+            self.buf = next(self.blks, None)
+            self.pos = 0
+            if self.buf is None:
+                self.buf = b''
+                return 0
+        n = min(len(b), len(self.buf) - self.pos)
+        b[:n] = self.buf[self.pos:self.pos+n]
+        self.pos += n
+        return n
+
+    def readall(self):
+        data = [self.buf[self.pos:]]
+        data.extend(self.blks)
+        self.buf = b''
+        self.pos = 0
+        return b"".join(data)
+
+    def close(self):
+        if hasattr(self.blks, "close"):
+            self.blks.close()
+        super(EntryReader, self).close()
+
+
+class ZipArchive(object):
+    """
+    Library interface to zipdump.
+
+        with ZipArchive("file.zip", password="secret") as z:
+            for ent in z.entries():
+                with z.open(ent) as fh:
+                    data = fh.read()
+
+    <source> is a filename, a url, or a seekable file object, which is not
+    closed by ZipArchive.  With usemmap=True local files are read through mmap.
+
+    With quick=True, the entries are CentralDirEntry objects from the central
+    directory, otherwise LocalFileHeader objects found by scanning the entire file.
+    Entries are parsed lazily, and kept after the first complete iteration.
+    """
+    def __init__(self, source, quick=True, password=None, usemmap=False, offset=None, length=None, chunksize=1024*1024, verbose=None):
+        import types
+        if isinstance(password, str):
+            password = password.encode('utf-8')
+        self.options = types.SimpleNamespace(quick=quick, password=password, offset=offset, length=length, chunksize=chunksize, verbose=verbose)
+        self.owned = []
+        if not isinstance(source, str):
+            self.fh = source
+        elif usemmap and source.find("://") not in (3,4,5) and os.path.getsize(source):
+            import mmap
+            fh = open(source, "rb")
+            self.owned.append(fh)
+            self.fh = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.fh = openfile(source)
+        if self.fh is not source:
+            self.owned.insert(0, self.fh)
+        self.cache = None
+        self.byname = None
+
+    def close(self):
+        for fh in self.owned:
+            fh.close()
+        self.owned = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def headers(self):
+        """
+        yields all PK headers, with their name, extra and comment loaded.
+        With quick=True, raises BadZipError when the central directory is not found.
+        """
+        if self.options.quick:
+            scanner = quickScanZip(self.options, self.fh)
+        else:
+            scanner = findPKHeaders(self.options, self.fh)
+        for ent in scanner:
+            ent.loaditems(self.fh)
+            yield ent
+
+    def isentry(self, ent):
+        """ True for the headers which describe a file """
+        return isinstance(ent, CentralDirEntry if self.options.quick else LocalFileHeader)
+
+    def entries(self):
+        """ yields the file entries, the parsed entries are kept after a complete iteration. """
+        if self.cache is not None:
+            yield from self.cache
+            return
+        cache = []
+        for ent in self.headers():
+            if self.isentry(ent):
+                cache.append(ent)
+                yield ent
+        self.cache = cache
+
+    def __iter__(self):
+        return self.entries()
+
+    def find(self, name):
+        """ returns the entry named <name>, or None """
+        if self.byname is None:
+            self.byname = { ent.name: ent for ent in self.entries() }
+        return self.byname.get(name)
+
+    def blocks(self, ent, mode="data"):
+        """
+        yields the data of <ent> in blocks, mode is one of:
+         * raw:       the data as stored in the archive
+         * decrypted: decrypted, without the 12 byte encryption header, but still compressed
+         * data:      decrypted and decompressed, raises ValueError at the end when the crc is wrong.
+        When the sizes are only in the DataDescriptor, the end of the data is found by decoding it.
+        """
+        if mode not in ("raw", "decrypted", "data"):
+            raise ValueError("invalid mode: %s" % mode)
+        if isinstance(ent, str):
+            name, ent = ent, self.find(ent)
+            if ent is None:
+                raise KeyError(name)
+        if ent.flags&1 and mode != "raw" and not self.options.password:
+            raise ValueError("%s is encrypted, and no password was specified" % ent.name)
+        if mode == "data":
+            return entryblocks(self.fh, ent, self.options.password)
+        if sizesknown(ent):
+            blks = zipraw(self.fh, ent)
+        else:
+            blks = entryblocks(self.fh, ent, self.options.password, decompress=False)
+        if mode == "raw":
+            return blks
+        if ent.flags&1:
+            blks = skipbytes(zip_decrypt(blks, self.options.password), 12, self.options)
+        return blks
+
+    def open(self, ent, mode="data"):
+        """ returns a file object for reading the data of <ent>, see blocks() for the modes. """
+        return EntryReader(self.blocks(ent, mode))
+
+    def read(self, ent, mode="data"):
+        return b"".join(self.blocks(ent, mode))
+
+    def extract(self, ent, path):
+        """ extract <ent> to <path>, returns True when the crc matched. """
+        return extractfile(self.options, self.fh, ent, path)
+
+
 def processfile(args, fh):
     """ Process one opened file / url. """
-    if args.quick:
-        scanner = quickScanZip(args, fh)
-    else:
-        scanner = findPKHeaders(args, fh)
+    args.output = OutputDir(args.outputdir)
+    if args.stream:
+        return processstream(args, fh)
+    if args.carve:
+        return carvefile(args, fh)
+    z = ZipArchive(fh, quick=args.quick, password=args.password, offset=args.offset, length=args.length, chunksize=args.chunksize, verbose=args.verbose)
 
     def checkarg(arg, ent):
         if not arg:
@@ -508,15 +1722,29 @@ def processfile(args, fh):
         if a: l += len(a)
         if b: l += len(b)
         return l > 1
+    def headers():
+        # entries found before a damaged directory are still processed
+        try:
+            yield from z.headers()
+        except BadZipError as e:
+            print(e)
 
     if args.verbose and not (args.cat or args.raw or args.save):
         print("   0304            need flgs  mth    stamp  --crc-- compsize fullsize nlen xlen      namofs     xofs   datofs   endofs")
         print("   0102            crea need flgs  mth    stamp  --crc-- compsize fullsize nlen xlen clen dsk0 attr osattr     datptr      namofs     xofs   cmtofs   endofs")
-    for ent in scanner:
+    for ent in headers():
+        if args.password_list and args.password is None and \
+                z.isentry(ent) and ent.flags&1 and not ent.flags&64:
+            args.password = z.options.password = recoverpassword(args, fh, ent)
+            # only try the list once, usually all entries use the same password.
+            args.password_list = None
+        if (args.plaintext or args.plaintext_hex) and args.password is None and \
+                z.isentry(ent) and ent.flags&1 and not ent.flags&64:
+            if not args.plaintext_entry or ent.name == args.plaintext_entry:
+                args.password = z.options.password = knownplaintextattack(args, fh, ent)
+                args.plaintext = args.plaintext_hex = None
         if args.cat or args.raw or args.save:
-            if args.quick and isinstance(ent, CentralDirEntry)  or \
-                        not args.quick and isinstance(ent, LocalFileHeader):
-                ent.loaditems(fh)
+            if z.isentry(ent):
                 do_cat = checkarg(args.cat, ent)
                 do_raw = checkarg(args.raw, ent)
                 do_save= checkarg(args.save, ent)
@@ -527,21 +1755,21 @@ def processfile(args, fh):
                     print("\n===> " + ent.name + " <===\n")
 
                 sys.stdout.flush()
-                blks = zipraw(fh, ent)
-
-                if args.password and ent.flags&1:
-                    blks = zip_decrypt(blks, args.password)
-                    if do_cat or do_save:
-                        blks = skipbytes(blks, 12, args)
-
-                if do_cat:
-                    sys.stdout.buffer.writelines(zipcat(blks, ent))
-                if do_raw:
-                    sys.stdout.buffer.writelines(blks)
+                try:
+                    if do_cat:
+                        sys.stdout.buffer.writelines(z.blocks(ent, "data"))
+                    if do_raw:
+                        blks = z.blocks(ent, "raw")
+                        if args.password and ent.flags&1:
+                            # --raw output includes the decrypted encryption header
+                            blks = zip_decrypt(blks, args.password)
+                        sys.stdout.buffer.writelines(blks)
+                except ValueError as e:
+                    sys.stdout.flush()
+                    sys.stderr.write("%s\n" % e)
                 if do_save:
-                    savefile(args.outputdir, ent.name, zipcat(blks, ent))
+                    saveentry(args, fh, ent)
         else:
-            ent.loaditems(fh)
             if args.verbose or not args.quick:
                 print("%08x: %s" % (ent.pkOffset, ent))
             else:
@@ -552,12 +1780,65 @@ def processfile(args, fh):
                 print("%08x: XTRA: %s" % (ent.extraOffset, binascii.b2a_hex(getbytes(fh, ent.extraOffset, ent.extraLength))))
             if args.dumpraw and hasattr(ent, "comment") and ent.comment:
                 print("%08x: CMT: %s" % (ent.commentOffset, binascii.b2a_hex(getbytes(fh, ent.commentOffset, ent.commentLength))))
-            if args.dumpraw and isinstance(ent, LocalFileHeader):
-                blks = zipraw(fh, ent)
+            if args.dumpraw and z.isentry(ent):
+                lfh = localheader(fh, ent)
                 if args.password and ent.flags&1:
-                    blks = zip_decrypt(blks, args.password)
+                    # decryption has to start at the start of the data
+                    blks = byterange(zip_decrypt(zipraw(fh, lfh), args.password), args.dump_offset, args.dump_length)
+                else:
+                    blks = byterange(zipraw(fh, lfh, args.dump_offset), 0, args.dump_length)
+
+                sys.stdout.flush()
+                hexdump(sys.stdout.buffer, lfh.dataOffset + args.dump_offset, blks, args.dump_width)
 
-                blockdump(ent.dataOffset, blks)
+
+def loaddirectory(args, fh):
+    """ Load the central directory using the quick scan, returns a dict indexed by name. """
+    z = ZipArchive(fh, quick=True, offset=args.offset, length=args.length, chunksize=args.chunksize)
+    return { ent.name: ent for ent in z.entries() }
+
+
+def diffzips(args, fha, fhb):
+    """
+    Compare two archives using only their central directories.
+    Entries are matched by name, and compared by crc and size.
+    With --save, the added and changed entries are extracted from the second archive.
+    """
+    args.output = OutputDir(args.outputdir)
+    try:
+        olddir = loaddirectory(args, fha)
+        newdir = loaddirectory(args, fhb)
+    except BadZipError as e:
+        print(e)
+        return
+
+    def checkarg(arg, ent):
+        if not arg:
+            return False
+        return '*' in arg or  ent.name in arg
+
+    changes = []
+    for name, ent in newdir.items():
+        old = olddir.get(name)
+        if old is None:
+            changes.append(('+', ent))
+        elif old.crc32 != ent.crc32 or old.originalSize != ent.originalSize:
+            changes.append(('M', ent))
+        elif args.verbose:
+            changes.append(('=', ent))
+    for name, ent in olddir.items():
+        if name not in newdir:
+            changes.append(('-', ent))
+
+    for change, ent in changes:
+        if change == 'M':
+            old = olddir[ent.name]
+            print("M %s  crc %08x -> %08x, size %d -> %d" % (ent.name, old.crc32, ent.crc32, old.originalSize, ent.originalSize))
+        else:
+            print("%s %s" % (change, ent.summary()))
+
+        if change in ('+', 'M') and checkarg(args.save, ent):
+            saveentry(args, fhb, ent)
 
 
 def DirEnumerator(args, path):
@@ -602,6 +1883,22 @@ def EnumeratePaths(args, paths):
             print("EXCEPTION %s accessing %s" % (e, fn))
 
 
+def positiveint(value):
+    """ argparse type for options which need a number >= 1 """
+    import argparse
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: %s" % value)
+    return n
+
+def nonnegativeint(value):
+    """ argparse type for offsets and sizes """
+    import argparse
+    n = int(value)
+    if n < 0:
+        raise argparse.ArgumentTypeError("must not be negative: %s" % value)
+    return n
+
 def main():
     import argparse
     parser = argparse.ArgumentParser(description='zipdump - scan file contents for PKZIP data',
@@ -619,10 +1916,24 @@ def main():
     parser.add_argument('--length', '-l', type=int, help='max length of data to process')
     parser.add_argument('--chunksize', type=int, default=1024*1024)
     parser.add_argument('--dumpraw', action='store_true', help='hexdump raw compressed data')
+    parser.add_argument('--dump-offset', type=nonnegativeint, default=0, help='with --dumpraw: start the hexdump at this offset in the entry data')
+    parser.add_argument('--dump-length', type=nonnegativeint, help='with --dumpraw: max nr of bytes to dump per entry')
+    parser.add_argument('--dump-width', type=positiveint, default=16, help='with --dumpraw: nr of bytes per line, default = 16')
+    parser.add_argument('--stream', action='store_true', help='single forward pass over the LocalFileHeaders, used automatically for non-seekable stdin')
+    parser.add_argument('--verify', action='store_true', help='with --stream: check the crc of all entries')
+    parser.add_argument('--carve', action='store_true', help='recover all entries from a damaged archive or disk image to the output directory')
+    parser.add_argument('--store', type=str, help='content addressed store shared between runs, entries already in the store are linked to the output directory without extracting them')
+    parser.add_argument('--diff', action='store_true', help='compare the central directories of two archives, with --save: extract the added and changed entries')
 
     parser.add_argument('--password', type=str, help="Password for pkzip decryption")
     parser.add_argument('--hexpassword', type=str, help="hexadecimal password for pkzip decryption")
     parser.add_argument('--keys', type=str, help="internal key representation for pkzip decryption")
+    parser.add_argument('--password-list', type=str, help="file with password candidates, one per line, to test against the first encrypted entry")
+    parser.add_argument('--plaintext', type=str, help="file with known plaintext, recovers the internal keys of the encrypted entry. needs numpy, about 20 msec cpu time per remaining candidate")
+    parser.add_argument('--plaintext-hex', type=str, help="hexadecimal known plaintext, at least 13 bytes")
+    parser.add_argument('--plaintext-offset', type=int, default=0, help="offset of the known plaintext in the (compressed) entry data")
+    parser.add_argument('--plaintext-entry', type=str, help="name of the entry the known plaintext belongs to, default = first encrypted entry")
+    parser.add_argument('--jobs', '-j', type=positiveint, help="number of processes used for password or key recovery, default = nr of cpus")
 
     parser.add_argument('FILES', type=str, nargs='*', help='Files or URLs')
     args = parser.parse_args()
@@ -636,25 +1947,35 @@ def main():
     elif args.password:
         args.password = args.password.encode('utf-8')
 
-    if args.FILES:
-        for fn in EnumeratePaths(args, args.FILES):
+    if args.store:
+        args.store = ExtractStore(args.store)
 
-            if len(args.FILES)>1 and not args.quiet:
-                print("\n==> " + fn + " <==\n")
-            try:
-                if fn.find("://") in (3,4,5):
-                    # when argument looks like a url, use urlstream to open
-                    import urlstream
-                    with urlstream.open(fn) as fh:
-                        processfile(args, fh)
-                else:
-                    with open(fn, "rb") as fh:
+    try:
+        if args.diff:
+            if len(args.FILES) != 2:
+                parser.error("--diff needs two files or urls")
+            with openfile(args.FILES[0]) as fha, openfile(args.FILES[1]) as fhb:
+                diffzips(args, fha, fhb)
+        elif args.FILES:
+            for fn in EnumeratePaths(args, args.FILES):
+
+                if len(args.FILES)>1 and not args.quiet:
+                    print("\n==> " + fn + " <==\n")
+                try:
+                    with openfile(fn) as fh:
                         processfile(args, fh)
-            except Exception as e:
-                print("ERROR: %s" % e)
-                raise
-    else:
-        processfile(args, sys.stdin.buffer)
+                except Exception as e:
+                    print("ERROR: %s" % e)
+                    raise
+        else:
+            if not sys.stdin.buffer.seekable():
+                args.stream = True
+            processfile(args, sys.stdin.buffer)
+    finally:
+        if args.store:
+            if not args.quiet:
+                print("store: %d entries reused, %d added" % (args.store.reused, len(args.store.added)), file=sys.stderr)
+            args.store.close()
 
 if __name__ == '__main__':
     main()